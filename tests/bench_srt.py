@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+# Times tusubtitulo.srt against a per-cue object implementation on a large
+# synthetic subtitle file, and compares their memory use. Run it from the
+# source tree root so tusubtitulo can be imported:
+#
+#   PYTHONPATH=. python3 tests/bench_srt.py [number of cues]
+
+
+import re
+import sys
+import time
+import tracemalloc
+
+
+from tusubtitulo import srt
+
+
+class Cue:
+    def __init__(self, start, end, text):
+        self.start = start
+        self.end = end
+        self.text = text
+
+
+def naive_parse(buff):
+    text, _ = srt.decode(buff)
+    ret = []
+    for block in re.split(r"\n[ \t]*\n", text):
+        lines = block.strip("\n").split("\n")
+        if len(lines) < 2:
+            continue
+
+        start, end = [
+            sum(
+                int(x) * y
+                for (x, y) in zip(
+                    re.split(r"[:,.]", x.strip()), (3600000, 60000, 1000, 1)
+                )
+            )
+            for x in lines[1].split("-->")
+        ]
+        ret.append(Cue(start, end, "\n".join(lines[2:])))
+
+    return ret
+
+
+def naive_shift_scale(cues, ms, factor):
+    ret = []
+    for cue in cues:
+        ret.append(
+            Cue(
+                int(round((cue.start + ms) * factor)),
+                int(round((cue.end + ms) * factor)),
+                cue.text,
+            )
+        )
+
+    return ret
+
+
+def naive_to_srt(cues):
+    parts = []
+    for (idx, cue) in enumerate(cues, 1):
+        parts.append(
+            "%d\r\n%s --> %s\r\n%s\r\n\r\n"
+            % (
+                idx,
+                srt._timestamp(cue.start),
+                srt._timestamp(cue.end),
+                cue.text.replace("\n", "\r\n"),
+            )
+        )
+
+    return "".join(parts).encode("utf-8")
+
+
+def build_sample(n):
+    parts = []
+    for idx in range(n):
+        start = idx * 3000
+        parts.append(
+            "%d\r\n%s --> %s\r\nLínea %d del subtítulo\r\ny otra\r\n\r\n"
+            % (
+                idx + 1,
+                srt._timestamp(start),
+                srt._timestamp(start + 2500),
+                idx,
+            )
+        )
+
+    return "".join(parts).encode("cp1252")
+
+
+def timeit(fn, *args):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        ret = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return (best, ret)
+
+
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    ret = fn(*args)
+    (current, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (current, ret)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    buff = build_sample(n)
+    print("%d cues, %.1f MiB" % (n, len(buff) / 2 ** 20))
+
+    (t_parse, cues) = timeit(srt.Cues.parse, buff)
+    (t_retime, retimed) = timeit(lambda: cues.shift(1500).scale(25 / 23.976))
+    (t_dump, _) = timeit(retimed.to_srt)
+
+    (n_parse, ncues) = timeit(naive_parse, buff)
+    (n_retime, nretimed) = timeit(naive_shift_scale, ncues, 1500, 25 / 23.976)
+    (n_dump, _) = timeit(naive_to_srt, nretimed)
+
+    print("%-10s %10s %10s" % ("", "columnar", "per-cue"))
+    for (name, a, b) in [
+        ("parse", t_parse, n_parse),
+        ("retime", t_retime, n_retime),
+        ("to_srt", t_dump, n_dump),
+    ]:
+        print("%-10s %9.3fs %9.3fs" % (name, a, b))
+
+    (m_cues, _) = peak_memory(srt.Cues.parse, buff)
+    (m_naive, _) = peak_memory(naive_parse, buff)
+    print("%-10s %8.1fMB %8.1fMB" % ("memory", m_cues / 1e6, m_naive / 1e6))
+
+
+if __name__ == "__main__":
+    main()
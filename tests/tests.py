@@ -19,12 +19,31 @@
 # USA.
 
 
+import argparse
+import contextlib
+import io
 import unittest
+import os
 import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
 from os import path
 
 
 import tusubtitulo
+import tusubtitulo.cli
+from tusubtitulo import (
+    cache,
+    index,
+    pipeline,
+    prefetch,
+    replay,
+    srt,
+    storage,
+)
 
 
 tusubtitulo._NETWORK_ENABLED = False
@@ -64,9 +83,23 @@ class MockResponse(object):
         self.encoding = "utf-8"
 
 
+class CountingFetcher(MockFetcher):
+    def __init__(self, overrides=None):
+        self.overrides = overrides or {}
+        self.urls = []
+
+    def fetch(self, url, headers={}):
+        self.urls.append(url)
+        if url in self.overrides:
+            return MockResponse(self.overrides[url])
+
+        return super(CountingFetcher, self).fetch(url, headers)
+
+
 class API(tusubtitulo.API):
     def __init__(self, *args, **kwargs):
-        super(API, self).__init__(fetcher=MockFetcher())
+        kwargs["fetcher"] = kwargs.get("fetcher") or MockFetcher()
+        super(API, self).__init__(*args, **kwargs)
 
 
 class ParsersTest(unittest.TestCase):
@@ -187,5 +220,837 @@ class FetcherTest(unittest.TestCase):
         self.assertEqual(fetcher._session.headers["X-Foo"], "foo")
 
 
+class PipelineTest(unittest.TestCase):
+    def test_fanout_and_order_independence(self):
+        def split(x):
+            yield x
+            yield x * 10
+
+        def double(x):
+            yield x * 2
+
+        p = pipeline.Pipeline(
+            [
+                pipeline.Stage("split", split, workers=2, maxsize=1),
+                pipeline.Stage("double", double, workers=3, maxsize=1),
+            ]
+        )
+        res = p.run(range(5))
+
+        self.assertEqual(
+            sorted(res),
+            sorted([2 * x for x in range(5)] + [20 * x for x in range(5)]),
+        )
+        self.assertEqual(p.stats[0].processed, 5)
+        self.assertEqual(p.stats[1].processed, 10)
+        self.assertTrue(p.stats[1].max_depth <= 1)
+
+    def test_errors(self):
+        errors = []
+
+        def check(x):
+            if x % 2:
+                raise ValueError(x)
+            yield x
+
+        p = pipeline.Pipeline(
+            [pipeline.Stage("check", check)],
+            on_error=lambda stage, item, e: errors.append((stage, item)),
+        )
+        res = p.run(range(4))
+
+        self.assertEqual(sorted(res), [0, 2])
+        self.assertEqual(sorted(errors), [("check", 1), ("check", 3)])
+        self.assertEqual(p.stats[0].errors, 2)
+
+    def test_broken_error_handler(self):
+        def fail(x):
+            raise ValueError(x)
+            yield
+
+        def on_error(stage, item, e):
+            raise RuntimeError()
+
+        p = pipeline.Pipeline(
+            [pipeline.Stage("fail", fail), pipeline.Stage("next", fail)],
+            on_error=on_error,
+        )
+        t = threading.Thread(target=p.run, args=(range(3),), daemon=True)
+        t.start()
+        t.join(3)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(p.stats[0].errors, 3)
+
+    def test_queue_size_arg(self):
+        self.assertEqual(tusubtitulo.cli._queue_size_arg("2"), 2)
+        for value in ("0", "-1", "foo"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                tusubtitulo.cli._queue_size_arg(value)
+
+    def test_download_for_raises(self):
+        with self.assertRaises(tusubtitulo.ParseError):
+            tusubtitulo.cli.download_for("/tmp/not-an-episode.txt")
+
+
+class NegativeCacheTest(unittest.TestCase):
+    incomplete_page = (
+        "<table>"
+        '<tr><td colspan="5">House 5x03 - Adverse Events</td></tr>'
+        '<tr><td colspan="3">Versión HDTV.XviD-LOL</td></tr>'
+        '<tr><td class="language">English</td><td>45.00%</td><td></td></tr>'
+        "</table>"
+    )
+
+    def setUp(self):
+        self.fetcher = CountingFetcher()
+        self.api = API(
+            fetcher=self.fetcher, negative_cache=cache.NegativeCache()
+        )
+
+    def test_missing_show(self):
+        for _ in range(2):
+            with self.assertRaises(tusubtitulo.ShowNotFoundError):
+                self.api.get_show("foo")
+
+        self.assertEqual(len(self.fetcher.urls), 1)
+
+    def test_missing_episode(self):
+        self.assertEqual(self.api.get_subtitles("house", "5", "30"), [])
+        self.assertEqual(self.api.get_subtitles("House", "5", "30"), [])
+        self.assertEqual(len(self.fetcher.urls), 2)
+
+        # Other episodes are not affected
+        self.assertEqual(len(self.api.get_subtitles("house", "5", "3")), 1)
+
+    def test_incomplete(self):
+        url = tusubtitulo.api.SEASON_PAGE_PATTERN.format(show="24", season="5")
+        self.fetcher.overrides[url] = self.incomplete_page
+
+        self.assertEqual(self.api.get_subtitles("house", "5", "3"), [])
+        self.assertTrue(self.api._negative.get("incomplete", "house/5/3"))
+        self.assertEqual(self.api.get_subtitles("house", "5", "3"), [])
+        self.assertEqual(len(self.fetcher.urls), 2)
+
+    def test_season_cache_after_expiration(self):
+        url = tusubtitulo.api.SEASON_PAGE_PATTERN.format(show="24", season="5")
+        self.fetcher.overrides[url] = self.incomplete_page
+        api = API(
+            fetcher=self.fetcher,
+            cache=cache.MemoryCache(),
+            negative_cache=cache.NegativeCache(ttls={"incomplete": -1}),
+        )
+
+        self.assertEqual(api.get_subtitles("house", "5", "3"), [])
+
+        # The cached season page must not outlive the negative entry
+        self.fetcher.overrides[url] = PrefetchTest.complete_page
+        info = api.get_subtitles("house", "5", "3")
+        self.assertEqual(info[0].url, "http://www.tusubtitulo.com/x/1")
+        self.assertEqual(len(self.fetcher.urls), 3)
+
+        # Completed episodes are served from the cache
+        api.get_subtitles("house", "5", "3")
+        self.assertEqual(len(self.fetcher.urls), 3)
+
+    def test_cli_repeated_miss(self):
+        url = tusubtitulo.api.SEASON_PAGE_PATTERN.format(show="24", season="5")
+        self.fetcher.overrides[url] = self.incomplete_page
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = path.join(tmpdir, "House 5x03.mkv")
+            p = tusubtitulo.cli.build_pipeline(self.api)
+            self.assertEqual(p.run([filename]), [])
+            self.assertEqual(len(self.fetcher.urls), 2)
+
+            # No index nor season fetch for the same miss
+            p = tusubtitulo.cli.build_pipeline(self.api)
+            self.assertEqual(p.run([filename]), [])
+            self.assertEqual(len(self.fetcher.urls), 2)
+            self.assertTrue(self.api.known_missing("House", "5", "3"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_season_cache_partly_translated(self):
+        url = tusubtitulo.api.SEASON_PAGE_PATTERN.format(show="24", season="5")
+        self.fetcher.overrides[url] = PrefetchTest.partial_page
+        api = API(
+            fetcher=self.fetcher,
+            cache=cache.MemoryCache(),
+            negative_cache=cache.NegativeCache(),
+        )
+
+        for _ in range(3):
+            info = api.get_subtitles("house", "5", "3")
+            self.assertEqual([x.language for x in info], ["en-us"])
+
+        self.assertEqual(len(self.fetcher.urls), 2)
+
+    def test_showinfo(self):
+        showinfo = self.api.get_show("house")
+        self.assertEqual(self.api.get_subtitles(showinfo, "5", "30"), [])
+        self.assertTrue(self.api._negative.get("episode", "House MD/5/30"))
+        self.assertEqual(self.api.get_subtitles(showinfo, "5", "30"), [])
+        self.assertEqual(len(self.fetcher.urls), 2)
+
+    def test_expiration(self):
+        negative = cache.NegativeCache(ttls={"show": -1})
+        negative.add("show", "foo")
+        self.assertFalse(negative.get("show", "foo"))
+
+    def test_disabled_kind(self):
+        negative = cache.NegativeCache(ttls={"show": 0})
+        negative.add("show", "foo")
+        self.assertFalse(negative.get("show", "foo"))
+
+    def test_shared_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = path.join(tmpdir, "negative.json")
+            cache.NegativeCache(filepath).add("episode", "house/5/30")
+            self.assertTrue(
+                cache.NegativeCache(filepath).get("episode", "House/5/30")
+            )
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class AliasTableTest(unittest.TestCase):
+    def setUp(self):
+        self.fetcher = CountingFetcher()
+        self.aliases = storage.AliasTable()
+        self.api = API(fetcher=self.fetcher, aliases=self.aliases)
+
+    def test_fuzzy_match_is_remembered(self):
+        info = self.api.get_show("mad man")
+        self.assertEqual(self.aliases.get("Mad  Man")["id"], "79")
+
+        again = self.api.get_show("Mad Man")
+        self.assertEqual((again.id, again.title), (info.id, info.title))
+        self.assertEqual(len(self.fetcher.urls), 1)
+
+    def test_override(self):
+        self.aliases.add("mad man", "1168", "Black Mirror")
+        self.api.get_show("mad man")
+        self.assertEqual(self.api.get_show("mad man").id, "1168")
+        self.assertEqual(self.fetcher.urls, [])
+
+    def test_user_edited_file(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = path.join(tmpdir, "aliases.json")
+            with open(filepath, "w") as fh:
+                fh.write('{"shield": "1768"}')
+
+            api = API(
+                fetcher=self.fetcher, aliases=storage.AliasTable(filepath)
+            )
+            info = api.get_show("Shield")
+            self.assertEqual(info.id, "1768")
+            self.assertEqual(info.url, "http://www.tusubtitulo.com/show/1768")
+            self.assertEqual(self.fetcher.urls, [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_not_found(self):
+        with self.assertRaises(tusubtitulo.ShowNotFoundError):
+            self.api.get_show("foo")
+        self.assertIsNone(self.aliases.get("foo"))
+
+    def test_hand_written_values(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = path.join(tmpdir, "aliases.json")
+            with open(filepath, "w") as fh:
+                fh.write(
+                    '{"shield": 1768, "lost": {"id": 42, "title": null}, '
+                    '"foo": [1], "bar": {"id": "x"}, "baz": true, '
+                    '"qux": null}'
+                )
+
+            aliases = storage.AliasTable(filepath)
+            self.assertEqual(aliases.get("shield")["id"], "1768")
+            self.assertEqual(
+                aliases.get("Lost"), {"id": "42", "title": "Lost"}
+            )
+            for name in ("foo", "bar", "baz", "qux"):
+                self.assertIsNone(aliases.get(name))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = path.join(self.tmpdir, "session.zip")
+
+        with replay.RecordingFetcher(MockFetcher(), self.path) as recorder:
+            API(fetcher=recorder).get_subtitles("house", "5", "3")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay(self):
+        api = API(fetcher=replay.ReplayFetcher(self.path))
+        info = api.get_subtitles("house", "5", "3")
+        self.assertEqual(len(info), 1)
+        self.assertEqual(info[0].version, "HDTV.XviD-LOL")
+
+    def test_missing_url(self):
+        fetcher = replay.ReplayFetcher(self.path)
+        with self.assertRaises(tusubtitulo.FetchError) as cm:
+            fetcher.fetch("http://www.tusubtitulo.com/foo")
+        self.assertEqual(cm.exception.status, 404)
+
+    def test_latency_and_errors(self):
+        delays = []
+        fetcher = replay.ReplayFetcher(
+            self.path,
+            latency=0.1,
+            jitter=0.05,
+            error_rate=0.5,
+            seed=1,
+            sleep=delays.append,
+        )
+
+        errors = 0
+        for _ in range(100):
+            try:
+                fetcher.fetch(tusubtitulo.api.SERIES_INDEX_URL)
+            except tusubtitulo.FetchError:
+                errors += 1
+
+        self.assertEqual(len(delays), 100)
+        self.assertTrue(all(0.05 <= x <= 0.15 for x in delays))
+        self.assertTrue(20 < errors < 80)
+
+    def test_save_leaves_no_temporary_files(self):
+        with replay.RecordingFetcher(MockFetcher(), self.path) as recorder:
+            recorder.fetch(tusubtitulo.api.SERIES_INDEX_URL)
+
+        self.assertEqual(os.listdir(self.tmpdir), ["session.zip"])
+
+    def test_error_rate_arg(self):
+        self.assertEqual(tusubtitulo.cli._rate_arg("0.25"), 0.25)
+        for value in ("-0.1", "1.5", "foo"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                tusubtitulo.cli._rate_arg(value)
+
+
+class MemcachedStandIn(socketserver.ThreadingTCPServer):
+    # Just enough of the memcached text protocol for MemcachedCache
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        self.data = {}
+        super(MemcachedStandIn, self).__init__(
+            ("127.0.0.1", 0), MemcachedHandler
+        )
+
+
+class MemcachedHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        data = self.server.data
+
+        for line in self.rfile:
+            parts = line.decode("ascii").split()
+            if parts[0] == "get":
+                if parts[1] in data:
+                    value = data[parts[1]]
+                    self.wfile.write(
+                        "VALUE {} 0 {}\r\n".format(
+                            parts[1], len(value)
+                        ).encode("ascii")
+                        + value
+                        + b"\r\n"
+                    )
+                self.wfile.write(b"END\r\n")
+
+            elif parts[0] == "set":
+                value = self.rfile.read(int(parts[4]) + 2)[:-2]
+                data[parts[1]] = value
+                self.wfile.write(b"STORED\r\n")
+
+            elif parts[0] == "delete":
+                found = data.pop(parts[1], None) is not None
+                self.wfile.write(b"DELETED\r\n" if found else b"NOT_FOUND\r\n")
+
+
+class CacheBackendTestMixin:
+    def test_get_set_delete(self):
+        self.assertIsNone(self.backend.get("foo"))
+
+        self.backend.set("foo", b"bar\r\nEND\r\n")
+        self.assertEqual(self.backend.get("foo"), b"bar\r\nEND\r\n")
+
+        self.backend.set("foo", b"")
+        self.assertEqual(self.backend.get("foo"), b"")
+
+        self.backend.delete("foo")
+        self.assertIsNone(self.backend.get("foo"))
+
+    def test_shared_by_api_instances(self):
+        fetchers = [CountingFetcher(), CountingFetcher()]
+        for fetcher in fetchers:
+            api = API(fetcher=fetcher, cache=self.backend)
+            info = api.get_subtitles("house", "5", "3")
+            self.assertEqual(
+                info[0].url, "http://www.tusubtitulo.com/updated/5/40/0"
+            )
+
+        self.assertEqual(len(fetchers[0].urls), 2)
+        self.assertEqual(fetchers[1].urls, [])
+
+    def test_numeric_arguments(self):
+        api = API(fetcher=CountingFetcher(), cache=self.backend)
+        self.assertEqual(len(api.get_subtitles("house", 5, "3")), 1)
+
+
+class MemoryCacheTest(CacheBackendTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.backend = cache.MemoryCache()
+
+    def test_expiration(self):
+        self.backend.set("foo", b"bar", ttl=-1)
+        self.assertIsNone(self.backend.get("foo"))
+
+
+class DiskCacheTest(CacheBackendTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backend = cache.open_backend(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_expiration(self):
+        self.backend.set("foo", b"bar", ttl=-1)
+        self.assertIsNone(self.backend.get("foo"))
+
+
+class MemcachedCacheTest(CacheBackendTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.server = MemcachedStandIn()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        host, port = self.server.server_address
+        self.backend = cache.open_backend(
+            "memcached://{}:{}".format(host, port)
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_server_down(self):
+        self.backend.set("foo", b"bar")
+        self.server.shutdown()
+        self.server.server_close()
+        self.backend._close()
+
+        # Failures are cache misses
+        self.assertIsNone(self.backend.get("foo"))
+        self.backend.set("foo", b"bar")
+
+
+class PrefetchTest(unittest.TestCase):
+    complete_page = NegativeCacheTest.incomplete_page.replace(
+        "<td>45.00%</td><td></td>",
+        '<td>Completado</td><td><a href="//www.tusubtitulo.com/x/1">'
+        "descargar</a></td>",
+    )
+    partial_page = complete_page.replace(
+        "</table>",
+        '<tr><td class="language">Español (Latinoamérica)</td>'
+        "<td>45.00%</td><td></td></tr>"
+        "</table>",
+    )
+
+    def setUp(self):
+        self.now = 1000
+        self.url = tusubtitulo.api.SEASON_PAGE_PATTERN.format(
+            show="24", season="5"
+        )
+        self.fetcher = CountingFetcher(
+            {self.url: NegativeCacheTest.incomplete_page}
+        )
+        self.api = API(
+            fetcher=self.fetcher,
+            cache=cache.MemoryCache(),
+            negative_cache=cache.NegativeCache(),
+        )
+        self.scheduler = prefetch.PrefetchScheduler(
+            self.api, min_interval=10, max_interval=100, clock=self.clock
+        )
+        self.api.prefetcher = self.scheduler
+
+    def clock(self):
+        return self.now
+
+    def test_warm_after_completion(self):
+        self.assertEqual(self.api.get_subtitles("house", "5", "3"), [])
+        self.assertEqual(len(self.scheduler.tracked), 1)
+
+        # Not due yet
+        self.scheduler.run_pending()
+        self.assertEqual(len(self.fetcher.urls), 2)
+
+        # English done, latin spanish still in progress
+        self.fetcher.overrides[self.url] = self.partial_page
+        self.now += 10
+        self.scheduler.run_pending()
+        self.assertEqual(len(self.fetcher.urls), 3)
+        self.assertEqual(len(self.scheduler.tracked), 1)
+
+        # Lookup is served from the refreshed cache
+        info = self.api.get_subtitles("house", "5", "3")
+        self.assertEqual(info[0].url, "http://www.tusubtitulo.com/x/1")
+        self.assertEqual(len(self.fetcher.urls), 3)
+
+        self.fetcher.overrides[self.url] = self.complete_page
+        self.now += 10
+        self.scheduler.run_pending()
+        self.assertEqual(len(self.fetcher.urls), 4)
+
+        # Nothing pending, no longer tracked
+        self.assertEqual(self.scheduler.tracked, [])
+
+        info = self.api.get_subtitles("house", "5", "3")
+        self.assertEqual(info[0].url, "http://www.tusubtitulo.com/x/1")
+        self.assertEqual(len(self.fetcher.urls), 4)
+
+    def test_forget_errors(self):
+        def forget_incomplete(*args):
+            raise OSError()
+
+        self.api.get_subtitles("house", "5", "3")
+        self.api.forget_incomplete = forget_incomplete
+
+        self.fetcher.overrides[self.url] = self.complete_page
+        self.now += 10
+        self.scheduler.run_pending()
+        self.assertEqual(self.scheduler.tracked, [])
+
+    def test_adaptive_interval(self):
+        self.api.get_subtitles("house", "5", "3")
+        entry = self.scheduler._tracked[("24", "5")]
+
+        intervals = []
+        for _ in range(5):
+            self.now = entry.due
+            self.scheduler.run_pending()
+            intervals.append(entry.due - self.now)
+
+        self.assertEqual(intervals, [10, 20, 40, 80, 100])
+
+    def test_expire(self):
+        self.api.get_subtitles("house", "5", "3")
+        self.now += self.scheduler.expire + 1
+        self.scheduler.run_pending()
+        self.assertEqual(self.scheduler.tracked, [])
+
+
+class CompiledIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = path.join(cls.tmpdir, "shows.idx")
+        API().compile_index(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        self.index = index.CompiledIndex(self.path)
+        self.fetcher = CountingFetcher()
+        self.api = API(fetcher=self.fetcher, show_index=self.index)
+
+    def tearDown(self):
+        self.index.close()
+
+    def test_matches(self):
+        for (query, id, title) in [
+            ("Black Mirror", "1168", "Black Mirror"),
+            ("z nation", "2201", "Z Nation"),
+            ("hawaii five 0", "695", None),
+            ("mad man", "79", "Mad Men"),
+        ]:
+            info = self.api.get_show(query)
+            self.assertEqual(info.id, id)
+            if title:
+                self.assertEqual(info.title, title)
+
+        self.assertEqual(self.fetcher.urls, [])
+
+    def test_missing_falls_back_to_index(self):
+        with self.assertRaises(tusubtitulo.ShowNotFoundError):
+            self.api.get_show("foo")
+        self.assertEqual(self.fetcher.urls, [tusubtitulo.api.SERIES_INDEX_URL])
+
+    def test_cli_broken_index(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive = path.join(tmpdir, "session.zip")
+            session = path.join(tmpdir, "session.json")
+            with replay.RecordingFetcher(MockFetcher(), archive) as recorder:
+                API(fetcher=recorder).get_index()
+
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                tusubtitulo.cli.download_all(
+                    [path.join(tmpdir, "notes.txt")],
+                    session=session,
+                    replay_from=archive,
+                    index_path=path.join(tmpdir, "missing", "shows.idx"),
+                    on_error=lambda stage, item, e: None,
+                )
+
+            self.assertIn("Unable to use index", stderr.getvalue())
+            self.assertTrue(path.exists(session))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_in_memory(self):
+        table = {
+            "Foo": "http://www.tusubtitulo.com/show/1",
+            "foo": "http://www.tusubtitulo.com/show/2",
+            "Bar Baz": "http://www.tusubtitulo.com/show/3",
+        }
+        idx = index.CompiledIndex(buff=index.compile_index(table))
+
+        self.assertEqual(len(idx), 3)
+        self.assertEqual(idx.find("foo"), ("foo", "2"))
+        self.assertEqual(idx.find("FOO"), ("Foo", "1"))
+        self.assertEqual(idx.find("bar  bas"), ("Bar Baz", "3"))
+        self.assertIsNone(idx.find("qux"))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            index.CompiledIndex(buff=b"\0" * 64)
+
+
+class SlowFetcher(CountingFetcher):
+    failing = ()
+
+    def fetch(self, url, headers={}):
+        if url in self.failing:
+            raise tusubtitulo.FetchError(url, 500)
+
+        if "/updated/" in url:
+            time.sleep(0.2)
+            resp = MockResponse("1\n00:00:01,000 --> 00:00:02,000\n" + url)
+            resp.content = resp.text.encode("utf-8")
+            return resp
+
+        return super(SlowFetcher, self).fetch(url, headers)
+
+
+class FetchSubtitlesTest(unittest.TestCase):
+    def setUp(self):
+        self.api = API(fetcher=SlowFetcher())
+
+    def test_concurrent(self):
+        subs = self.api.get_subtitles("American Horror Story", "5", "3")
+        self.assertEqual(len(subs), 5)
+
+        start = time.monotonic()
+        res = list(self.api.fetch_subtitles(subs))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual({sub for (sub, _, _) in res}, set(subs))
+        for (sub, content, error) in res:
+            self.assertIsNone(error)
+            self.assertTrue(content.endswith(sub.url.encode("utf-8")))
+        self.assertTrue(elapsed < 0.6)
+
+    def test_partial_failure(self):
+        subs = self.api.get_subtitles("American Horror Story", "5", "3")
+        self.api._fetcher.failing = {subs[0].url}
+
+        res = {
+            sub: (content, error)
+            for (sub, content, error) in self.api.fetch_subtitles(subs)
+        }
+
+        self.assertEqual(len(res), 5)
+        (content, error) = res.pop(subs[0])
+        self.assertIsNone(content)
+        self.assertIsInstance(error, tusubtitulo.FetchError)
+        self.assertTrue(all(error is None for (_, error) in res.values()))
+
+    def test_empty(self):
+        self.assertEqual(list(self.api.fetch_subtitles([])), [])
+
+    def test_cli_download(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = path.join(tmpdir, "American Horror Story 5x03.mkv")
+            open(path.join(tmpdir, filename[:-4] + ".en.srt"), "w").close()
+
+            p = tusubtitulo.cli.build_pipeline(
+                self.api, languages=["es-es", "es-lat", "en-us"]
+            )
+            res = p.run([filename])
+
+            self.assertEqual(
+                sorted(path.basename(x) for x in res),
+                [
+                    "American Horror Story 5x03.es.srt",
+                    "American Horror Story 5x03.lat.srt",
+                ],
+            )
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cli_download_one_language_fails(self):
+        subs = self.api.get_subtitles("American Horror Story", "5", "3")
+        self.api._fetcher.failing = {
+            sub.url for sub in subs if sub.language == "es-es"
+        }
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = path.join(tmpdir, "American Horror Story 5x03.mkv")
+
+            errors = []
+            p = tusubtitulo.cli.build_pipeline(
+                self.api,
+                languages=["es-es", "es-lat"],
+                on_error=lambda stage, item, e: errors.append((stage, e)),
+            )
+            res = p.run([filename])
+
+            self.assertEqual(
+                [path.basename(x) for x in res],
+                ["American Horror Story 5x03.lat.srt"],
+            )
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(errors[0][0], "download")
+            self.assertIsInstance(errors[0][1], tusubtitulo.FetchError)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class SrtTest(unittest.TestCase):
+    sample = (
+        "\ufeff1\r\n"
+        "00:00:01,000 --> 00:00:02,500\r\n"
+        "Hola\r\n"
+        "¿qué tal?\r\n"
+        "\r\n"
+        "2\r\n"
+        "00:00:03,000 --> 00:00:04,000\r\n"
+        "\r\n"
+        "3\r\n"
+        "01:00:03,5 --> 01:00:04,000 X1:10\r\n"
+        "Adiós"
+    )
+
+    def test_parse(self):
+        cues = srt.Cues.parse(self.sample.encode("utf-8"))
+        self.assertEqual(
+            list(cues),
+            [
+                (1000, 2500, "Hola\n¿qué tal?"),
+                (3000, 4000, ""),
+                (3603500, 3604000, "Adiós"),
+            ],
+        )
+        self.assertEqual(cues.cue_text(2), "Adiós")
+
+    def test_encodings(self):
+        buff = self.sample[1:].encode("cp1252")
+        self.assertEqual(srt.decode(buff)[1], "cp1252")
+        normalized = srt.normalize(buff)
+        self.assertTrue("01:00:03,500 --> " in normalized.decode("utf-8"))
+        self.assertEqual(
+            list(srt.Cues.parse(normalized)), list(srt.Cues.parse(self.sample))
+        )
+
+        buff = self.sample.encode("utf-16")
+        self.assertEqual(len(srt.Cues.parse(buff)), 3)
+
+    def test_retime(self):
+        cues = srt.Cues.parse(self.sample)
+
+        self.assertEqual(list(cues.shift(-1500).starts), [0, 1500, 3602000])
+        self.assertEqual(
+            list(cues.scale(2, origin=1000).ends), [4000, 7000, 7207000]
+        )
+        self.assertEqual(
+            list(cues.retime(0.5, 100).starts), [600, 1600, 1801850]
+        )
+        # Original is untouched
+        self.assertEqual(list(cues.starts), [1000, 3000, 3603500])
+
+    def test_roundtrip(self):
+        cues = srt.Cues.parse(self.sample)
+        again = srt.Cues.parse(cues.to_srt(encoding="latin-1", newline="\n"))
+        self.assertEqual(list(again), list(cues))
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = path.join(self.tmpdir, "session.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_atomic_write(self):
+        with storage.atomic_write(self.path) as fh:
+            fh.write("foo")
+
+        with self.assertRaises(ValueError):
+            with storage.atomic_write(self.path) as fh:
+                fh.write("bar")
+                raise ValueError()
+
+        with open(self.path) as fh:
+            self.assertEqual(fh.read(), "foo")
+        self.assertEqual(os.listdir(self.tmpdir), ["session.json"])
+
+    def test_roundtrip(self):
+        fetcher = MockFetcher()
+        fetcher.set_state(
+            {
+                "headers": {"Referer": "http://foo/", "User-Agent": "x"},
+                "cookies": {"PHPSESSID": "abc"},
+            }
+        )
+        storage.SessionStore(self.path).save(fetcher)
+
+        other = MockFetcher()
+        other.set_state({"headers": {"User-Agent": "y"}, "cookies": {}})
+        self.assertTrue(storage.SessionStore(self.path).restore(other))
+
+        state = other.get_state()
+        self.assertEqual(state["cookies"], {"PHPSESSID": "abc"})
+        self.assertEqual(state["headers"]["Referer"], "http://foo/")
+        # Only cookies and referer are persisted
+        self.assertEqual(state["headers"]["User-Agent"], "y")
+
+    def test_restore_missing(self):
+        fetcher = MockFetcher()
+        self.assertFalse(storage.SessionStore(self.path).restore(fetcher))
+
+    def test_save_merges_cookies(self):
+        a = MockFetcher()
+        a.set_state({"headers": {}, "cookies": {"a": "1", "c": "old"}})
+        b = MockFetcher()
+        b.set_state({"headers": {}, "cookies": {"b": "2", "c": "new"}})
+
+        storage.SessionStore(self.path).save(a)
+        storage.SessionStore(self.path).save(b)
+
+        self.assertEqual(
+            storage.JSONFile(self.path).load()["cookies"],
+            {"a": "1", "b": "2", "c": "new"},
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
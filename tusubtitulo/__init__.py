@@ -18,6 +18,6 @@
 # USA.
 
 
-from .api import API, ShowNotFoundError, ParseError
+from .api import API, ShowNotFoundError, ParseError, FetchError
 
-__all__ = ["API", "ShowNotFoundError", "ParseError"]
+__all__ = ["API", "ShowNotFoundError", "ParseError", "FetchError"]
@@ -18,8 +18,10 @@
 # USA.
 
 
+import concurrent.futures
 import difflib
 import hashlib
+import json
 import re
 
 
@@ -28,6 +30,9 @@ import guessit
 import requests
 
 
+from tusubtitulo import index
+
+
 _NETWORK_ENABLED = True
 
 MAIN_URL = "http://www.tusubtitulo.com/"
@@ -38,16 +43,130 @@ SEASON_PAGE_PATTERN = (
 )
 
 
+# Seconds to keep each kind of data in the cache backend, if any
+DEFAULT_CACHE_TTLS = {"index": 24 * 60 * 60, "season": 30 * 60}
+
+# Bump if the format of cached data changes
+_CACHE_VERSION = "1"
+
+
 class API:
-    def __init__(self, fetcher=None):
+    def __init__(
+        self,
+        fetcher=None,
+        negative_cache=None,
+        aliases=None,
+        cache=None,
+        cache_ttls=None,
+        prefetcher=None,
+        show_index=None,
+    ):
         if fetcher is None:
             fetcher = Fetcher()
         self._fetcher = fetcher
+        self._negative = negative_cache
+        self._aliases = aliases
+        self._cache = cache
+        self._cache_ttls = dict(DEFAULT_CACHE_TTLS)
+        self._cache_ttls.update(cache_ttls or {})
+        self.prefetcher = prefetcher
+        self.show_index = show_index
+
+    @property
+    def cache_ttls(self):
+        return dict(self._cache_ttls)
+
+    def _cache_key(self, *parts):
+        return ":".join(map(str, ("tusubtitulo", _CACHE_VERSION) + parts))
 
     def fetch(self, url, headers={}):
         return self._fetcher.fetch(url, headers)
 
+    def _cached(self, key, ttl, fn, refresh=False, usable=None):
+        # `usable` can reject a cached value, it is fetched again
+        if self._cache is None:
+            return fn()
+
+        buff = None if refresh else self._cache.get(key)
+        if buff is not None:
+            try:
+                data = json.loads(buff.decode("utf-8"))
+            except ValueError:
+                pass
+            else:
+                if usable is None or usable(data):
+                    return data
+
+        data = fn()
+        self._cache.set(key, json.dumps(data).encode("utf-8"), ttl)
+
+        return data
+
+    def get_index(self):
+        ttl = self._cache_ttls["index"]
+
+        def _fetch():
+            resp = self.fetch(SERIES_INDEX_URL, {"Referer": MAIN_URL})
+            return parse_index_page(resp.text)
+
+        return self._cached(self._cache_key("index"), ttl, _fetch)
+
+    def compile_index(self, filepath):
+        index.write_index(filepath, self.get_index())
+
+    def get_season(self, showinfo, season, refresh=False, episode=None):
+        """
+        Rows of the season page, see parse_season_rows.
+
+        If `episode` is given a cached page is only used when it lists a
+        completed translation of the episode, otherwise the page is fetched
+        again: the cached copy may be older than the negative cache
+        entries.
+        """
+        ttl = self._cache_ttls["season"]
+
+        def _fetch():
+            resp = self.fetch(
+                SEASON_PAGE_PATTERN.format(show=showinfo.id, season=season),
+                {"Referer": showinfo.url},
+            )
+            return parse_season_rows(resp.text)
+
+        def _usable(rows):
+            # Same meaning as the "incomplete" negative entry: the episode
+            # is usable once any of its translations is completed
+            return any(
+                row[4] for row in rows if row[0] is None or row[0] == episode
+            )
+
+        key = self._cache_key("season", showinfo.id, season)
+        rows = self._cached(
+            key,
+            ttl,
+            _fetch,
+            refresh=refresh,
+            usable=_usable if episode is not None else None,
+        )
+
+        return [tuple(row) for row in rows]
+
     def get_show(self, show):
+        if self._aliases:
+            alias = self._aliases.get(show)
+            if alias:
+                return ShowInfo(
+                    title=alias["title"],
+                    id=alias["id"],
+                    url=SERIES_PAGE_PATTERN.format(show=alias["id"]),
+                )
+
+        showinfo = self._search_show(show)
+        if self._aliases:
+            self._aliases.add(show, showinfo.id, showinfo.title)
+
+        return showinfo
+
+    def _search_show(self, show):
         def _get_id_from_url(url):
             m = re.match(MAIN_URL + r"show/(\d+)", url, flags=re.IGNORECASE)
 
@@ -56,10 +175,23 @@ class API:
 
             return m.group(1)
 
-        buff = self.fetch(SERIES_INDEX_URL, {"Referer": MAIN_URL}).text
+        if self._negative and self._negative.get("show", show):
+            raise ShowNotFoundError(show)
+
+        # The compiled index may be outdated, shows not found there are
+        # searched in the current index
+        if self.show_index is not None:
+            found = self.show_index.find(show)
+            if found:
+                (title, id) = found
+                return ShowInfo(
+                    title=title,
+                    id=id,
+                    url=SERIES_PAGE_PATTERN.format(show=id),
+                )
 
         # Search exact match
-        table = parse_index_page(buff)
+        table = self.get_index()
         rev = {v: k for (k, v) in table.items()}
 
         if show in table:
@@ -86,9 +218,37 @@ class API:
             url = lc_table[first[0]]
             return ShowInfo(title=rev[url], id=_get_id_from_url(url), url=url)
 
+        if self._negative:
+            self._negative.add("show", show)
+
         raise ShowNotFoundError(show)
 
-    def get_subtitles(self, show, season, episode=None):
+    @staticmethod
+    def _negative_key(name, season, episode):
+        return "{}/{}/{}".format(name, season, episode)
+
+    def known_missing(self, show, season, episode=None):
+        """
+        True if a recent lookup of this episode, made with the same show
+        name, found it missing or not translated yet.
+
+        Costs no network, callers can use it before resolving the show.
+        """
+        if not self._negative:
+            return False
+
+        negative_key = self._negative_key(show, season, episode)
+        return bool(
+            self._negative.get("episode", negative_key)
+            or self._negative.get("incomplete", negative_key)
+        )
+
+    def get_subtitles(self, show, season, episode=None, name=None):
+        """
+        `show` is a show name or a ShowInfo. Negative cache entries are
+        keyed by `name`, the show name as requested, which defaults to
+        `show` or its title.
+        """
         # Incoming data is unicode, but language codes are simple strings
         language_table = {
             "english": "en-us",
@@ -96,19 +256,32 @@ class API:
             "español (latinoamérica)": "es-lat",
         }
 
-        showinfo = self.get_show(show)
-        resp = self.fetch(
-            SEASON_PAGE_PATTERN.format(show=showinfo.id, season=season),
-            {"Referer": showinfo.url},
-        )
-        season_data = parse_season_page(resp.text)
+        if name is None:
+            name = show.title if isinstance(show, ShowInfo) else show
+
+        if self.known_missing(name, season, episode):
+            return []
+
+        if isinstance(show, ShowInfo):
+            showinfo = show
+        else:
+            showinfo = self.get_show(show)
+
+        season_data = self.get_season(showinfo, season, episode=episode)
 
         state = self._fetcher.get_state()
         ret = []
-        for (ep, title, version, language, url) in season_data:
+        listed = False
+        pending = False
+        for (ep, title, version, language, completed, url) in season_data:
             if ep is not None and ep != episode:
                 continue
 
+            listed = True
+            if not completed:
+                pending = True
+                continue
+
             try:
                 language = language_table[language.lower()]
             except KeyError:
@@ -127,9 +300,21 @@ class API:
                 )
             )
 
+        if self._negative and not ret:
+            kind = "incomplete" if listed else "episode"
+            self._negative.add(kind, self._negative_key(name, season, episode))
+
+        if self.prefetcher and pending:
+            self.prefetcher.track(showinfo, season, episode, name)
+
         return ret
 
-    def get_subtitles_from_filename(self, filename):
+    def forget_incomplete(self, show, season, episode):
+        if self._negative:
+            negative_key = self._negative_key(show, season, episode)
+            self._negative.discard("incomplete", negative_key)
+
+    def parse_filename(self, filename):
         try:
             info = guessit.guessit(filename)
         except guessit.api.GuessitException as e:
@@ -149,9 +334,10 @@ class API:
         else:
             series = info["title"]
 
-        return self.get_subtitles(
-            series, str(info["season"]), str(info["episode"])
-        )
+        return (series, str(info["season"]), str(info["episode"]))
+
+    def get_subtitles_from_filename(self, filename):
+        return self.get_subtitles(*self.parse_filename(filename))
 
     def fetch_subtitle(self, subtitle_info):
         headers = {
@@ -167,6 +353,34 @@ class API:
         # logger.debug(msg)
         return resp.content
 
+    def fetch_subtitles(self, subtitle_infos, max_workers=None):
+        """
+        Download several subtitles concurrently.
+
+        Yields (subtitle_info, content, error) as downloads finish. A
+        failed download has content None and the exception as error, it
+        does not stop the others.
+        """
+        subtitle_infos = list(subtitle_infos)
+        if not subtitle_infos:
+            return
+
+        if max_workers is None:
+            max_workers = len(subtitle_infos)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(self.fetch_subtitle, info): info
+                for info in subtitle_infos
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    content = future.result()
+                except Exception as e:
+                    yield (futures[future], None, e)
+                else:
+                    yield (futures[future], content, None)
+
 
 class ShowInfo:
     def __init__(self, title, id, url):
@@ -233,6 +447,18 @@ class ParseError(Exception):
     pass
 
 
+class FetchError(Exception):
+    def __init__(self, url, status=None, *args, **kwargs):
+        self.url = url
+        self.status = status
+        super(FetchError, self).__init__(*args, **kwargs)
+
+    def __str__(self):
+        return "Unable to fetch {url} (status: {status})".format(
+            url=self.url, status=self.status
+        )
+
+
 #
 # Parsers
 #
@@ -258,7 +484,13 @@ def parse_index_page(buff):
     }
 
 
-def parse_season_page(buff):
+def parse_season_rows(buff):
+    """
+    Like parse_season_page but includes translations still in progress.
+
+    Each row is (episode, title, version, language, completed, url), url is
+    None for incomplete rows.
+    """
     ret = []
 
     curr_episode_title = None
@@ -294,15 +526,15 @@ def parse_season_page(buff):
 
             completed_node = td.findNextSibling("td")
             completed = completed_node.text.strip().lower() == "completado"
-            if completed is False:
-                continue
 
-            link_node = completed_node.findNextSibling("td").select("a")[0]
+            href = None
+            if completed:
+                link_node = completed_node.findNextSibling("td").select("a")[0]
 
-            try:
-                href = "http:" + link_node.attrs["href"]
-            except KeyError:
-                continue
+                try:
+                    href = "http:" + link_node.attrs["href"]
+                except KeyError:
+                    continue
 
             ret.append(
                 (
@@ -310,6 +542,7 @@ def parse_season_page(buff):
                     curr_episode_title,
                     curr_episode_version,
                     language,
+                    completed,
                     href,
                 )
             )
@@ -317,11 +550,33 @@ def parse_season_page(buff):
     return ret
 
 
+def parse_season_page(buff):
+    return [
+        (ep, title, version, language, url)
+        for (ep, title, version, language, completed, url) in (
+            parse_season_rows(buff)
+        )
+        if completed
+    ]
+
+
 #
 # Network
 #
 
 
+class Response:
+    def __init__(self, url, content, encoding=None, status_code=200):
+        self.url = url
+        self.content = content
+        self.encoding = encoding or "utf-8"
+        self.status_code = status_code
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+
 class Fetcher(object):
     def __init__(self, headers={}):
         default_headers = {
@@ -355,7 +610,7 @@ class Fetcher(object):
 
         resp = self._session.get(url, headers=headers_)
         if resp.status_code != 200:
-            raise Exception("Invalid response")
+            raise FetchError(url, resp.status_code)
 
         self._headers.update({"Referer": url})
 
@@ -0,0 +1,345 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import abc
+import hashlib
+import os
+import socket
+import struct
+import threading
+import time
+from os import path
+from urllib import parse
+
+from tusubtitulo import storage
+
+
+class NegativeCache:
+    """
+    Remembers lookups that failed so they are not retried for a while.
+
+    Kinds:
+      - show: show name not found in the index
+      - episode: episode not listed in the season page
+      - incomplete: episode listed but without any completed translation
+
+    Entries live in memory or, if `filepath` is given, in a JSON file shared
+    between processes.
+    """
+
+    KINDS = ("show", "episode", "incomplete")
+    DEFAULT_TTLS = {
+        "show": 6 * 60 * 60,
+        "episode": 30 * 60,
+        "incomplete": 10 * 60,
+    }
+
+    def __init__(self, filepath=None, ttls=None):
+        self.ttls = dict(self.DEFAULT_TTLS)
+        for (kind, ttl) in (ttls or {}).items():
+            if kind not in self.KINDS:
+                raise ValueError(kind)
+            self.ttls[kind] = ttl
+
+        self._file = storage.JSONFile(filepath) if filepath else None
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(kind, key):
+        return "{}:{}".format(kind, key.lower())
+
+    def _load(self):
+        if self._file:
+            return self._file.load()
+
+        return self._memory
+
+    def _update(self, fn):
+        if self._file:
+            self._file.update(fn)
+        else:
+            with self._lock:
+                self._memory = fn(self._memory)
+
+    def get(self, kind, key):
+        expires = self._load().get(self._key(kind, key))
+        return expires is not None and expires > time.time()
+
+    def add(self, kind, key):
+        ttl = self.ttls[kind]
+        if not ttl:
+            return
+
+        now = time.time()
+
+        def _add(data):
+            data = {k: v for (k, v) in data.items() if v > now}
+            data[self._key(kind, key)] = now + ttl
+            return data
+
+        self._update(_add)
+
+    def discard(self, kind, key):
+        k = self._key(kind, key)
+
+        def _discard(data):
+            data.pop(k, None)
+            return data
+
+        self._update(_discard)
+
+
+#
+# Backends
+#
+
+
+class CacheBackend(abc.ABC):
+    """
+    Key-value store for parsed results.
+
+    Keys are strings, values are bytes. `ttl` is in seconds, None means no
+    expiration. Backends must be safe to use from several threads and
+    should treat their own failures as cache misses.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, value, ttl=None):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+
+class MemoryCache(CacheBackend):
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                (expires, value) = self._data[key]
+            except KeyError:
+                return None
+
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                return None
+
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class DiskCache(CacheBackend):
+    """
+    One file per key, named after the key hash, prefixed with the expiration
+    time. Files are replaced atomically so several processes can share the
+    directory.
+    """
+
+    _HEADER = struct.Struct("!d")
+
+    def __init__(self, dirpath):
+        self._dir = dirpath
+        os.makedirs(dirpath, exist_ok=True)
+
+    def _path(self, key):
+        return path.join(
+            self._dir, hashlib.sha1(key.encode("utf-8")).hexdigest()
+        )
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as fh:
+                buff = fh.read()
+        except OSError:
+            return None
+
+        if len(buff) < self._HEADER.size:
+            return None
+
+        (expires,) = self._HEADER.unpack_from(buff)
+        if expires and expires <= time.time():
+            self.delete(key)
+            return None
+
+        return buff[self._HEADER.size :]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else 0
+        try:
+            with storage.atomic_write(self._path(key), "wb") as fh:
+                fh.write(self._HEADER.pack(expires))
+                fh.write(value)
+
+        except OSError:
+            pass
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+
+class MemcachedCache(CacheBackend):
+    """
+    Client for the memcached text protocol, shared by every worker pointing
+    at the same server.
+    """
+
+    # memcached treats expirations over 30 days as unix timestamps
+    _MAX_RELATIVE_TTL = 30 * 24 * 60 * 60
+
+    def __init__(self, host="localhost", port=11211, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self._sock = None
+        self._rfile = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(key):
+        # memcached keys can't contain spaces or control chars and are
+        # limited to 250 bytes
+        return "tusubtitulo:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.create_connection(
+                (self.host, self.port), timeout=self.timeout
+            )
+            self._rfile = self._sock.makefile("rb")
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._rfile.close()
+                self._sock.close()
+            except OSError:
+                pass
+
+        self._sock = None
+        self._rfile = None
+
+    def _command(self, fn):
+        with self._lock:
+            try:
+                self._connect()
+                return fn()
+
+            except (OSError, ValueError):
+                # Connection lost or protocol out of sync, start over on
+                # the next command
+                self._close()
+                return None
+
+    def _readline(self):
+        line = self._rfile.readline()
+        if not line.endswith(b"\r\n"):
+            raise ValueError("Connection closed")
+
+        return line[:-2]
+
+    def get(self, key):
+        key = self._key(key)
+
+        def _get():
+            self._sock.sendall("get {}\r\n".format(key).encode("ascii"))
+
+            value = None
+            while True:
+                line = self._readline()
+                if line == b"END":
+                    return value
+
+                parts = line.split()
+                if len(parts) != 4 or parts[0] != b"VALUE":
+                    raise ValueError(line)
+
+                size = int(parts[3])
+                value = self._rfile.read(size + 2)[:-2]
+
+        return self._command(_get)
+
+    def set(self, key, value, ttl=None):
+        key = self._key(key)
+        if ttl is None:
+            exptime = 0
+        elif ttl > self._MAX_RELATIVE_TTL:
+            exptime = int(time.time() + ttl)
+        else:
+            exptime = max(1, int(ttl))
+
+        def _set():
+            cmd = "set {} 0 {} {}\r\n".format(key, exptime, len(value))
+            self._sock.sendall(cmd.encode("ascii") + value + b"\r\n")
+            return self._readline() == b"STORED"
+
+        self._command(_set)
+
+    def delete(self, key):
+        key = self._key(key)
+
+        def _delete():
+            self._sock.sendall("delete {}\r\n".format(key).encode("ascii"))
+            return self._readline() == b"DELETED"
+
+        self._command(_delete)
+
+
+def open_backend(uri):
+    """
+    Build a backend from a string:
+      - memory
+      - memcached://host[:port]
+      - a directory path (or file:///path) for DiskCache
+    """
+    if uri == "memory":
+        return MemoryCache()
+
+    parsed = parse.urlparse(uri)
+    if parsed.scheme == "memcached":
+        return MemcachedCache(parsed.hostname, parsed.port or 11211)
+
+    if parsed.scheme == "file":
+        return DiskCache(parsed.path)
+
+    if not parsed.scheme:
+        return DiskCache(uri)
+
+    raise ValueError("Unknown cache backend: {}".format(uri))
@@ -20,56 +20,293 @@
 
 import argparse
 import sys
+import time
 from os import path
 
 import tusubtitulo
+from tusubtitulo import api as tsapi
+from tusubtitulo import cache, index, pipeline, replay, storage
 
 
-def download_for(filename, languages=None):
-    extension_table = {"en-us": "en", "es-es": "es", "es-lat": "lat"}
+EXTENSION_TABLE = {"en-us": "en", "es-es": "es", "es-lat": "lat"}
 
-    api = tusubtitulo.API()
+DEFAULT_WORKERS = {"resolve": 1, "fetch": 2, "select": 1, "download": 2}
 
-    subs = {}
 
-    for sub in api.get_subtitles_from_filename(path.basename(filename)):
-        if sub.language not in subs:
-            subs[sub.language] = []
-        subs[sub.language].append(sub)
+def _select_best(subs):
+    # Try to download proper version
+    versions = [sub.version.lower() for sub in subs]
+    propers = ["proper" in ver or "repack" in ver for ver in versions]
+    try:
+        return subs[propers.index(True)]
+    except ValueError:
+        return sorted(subs, key=lambda x: x.url)[-1]
 
-    for (language, subs) in subs.items():
-        if languages and language not in languages:
-            continue
 
-        # Try to download proper version
-        versions = [sub.version.lower() for sub in subs]
-        propers = ["proper" in ver or "repack" in ver for ver in versions]
-        try:
-            match = subs[propers.index(True)]
-        except ValueError:
-            match = sorted(subs, key=lambda x: x.url)[-1]
+def build_pipeline(
+    api, languages=None, workers=None, queue_size=4, on_error=None
+):
+    workers_ = dict(DEFAULT_WORKERS)
+    workers_.update(workers or {})
+    on_error = on_error or _report_error
+
+    def resolve(filename):
+        series, season, episode = api.parse_filename(path.basename(filename))
+
+        # Repeated misses are skipped before resolving the show, which may
+        # need the show index
+        if api.known_missing(series, season, episode):
+            return
+
+        yield (filename, series, api.get_show(series), season, episode)
+
+    def fetch(job):
+        filename, series, showinfo, season, episode = job
+        subs = api.get_subtitles(showinfo, season, episode, name=series)
+        yield (filename, subs)
+
+    def select(job):
+        filename, subs = job
+
+        table = {}
+        for sub in subs:
+            if sub.language not in table:
+                table[sub.language] = []
+            table[sub.language].append(sub)
+
+        selected = []
+        for (language, subs) in table.items():
+            if languages and language not in languages:
+                continue
+
+            match = _select_best(subs)
+
+            name, ext = path.splitext(filename)
+            subname = "%(name)s.%(language)s.srt" % dict(
+                name=name, language=EXTENSION_TABLE[match.language]
+            )
+
+            if path.exists(subname):
+                msg = (
+                    "Skipping %(language)s ,"
+                    "filename %(subtitle_name)s already exists"
+                )
+                msg = msg % dict(
+                    language=match.language, subtitle_name=subname
+                )
+                print(msg)
+                continue
+
+            selected.append((subname, match))
 
-        name, ext = path.splitext(filename)
-        subname = "%(name)s.%(language)s.srt" % dict(
-            name=name, language=extension_table[match.language]
-        )
+        if selected:
+            yield (filename, selected)
+
+    def download(job):
+        filename, selected = job
+        subnames = {match: subname for (subname, match) in selected}
+
+        # All languages of the file are downloaded at once, a failed one
+        # is reported without discarding the others
+        for (match, buff, error) in api.fetch_subtitles(subnames):
+            subname = subnames[match]
+            if error is not None:
+                on_error("download", (subname, match), error)
+                continue
 
-        if not path.exists(subname):
             with open(subname, "wb+") as fh:
-                buff = api.fetch_subtitle(match)
                 fh.write(buff)
 
             msg = "Saved %(language)s subtitle to %(subtitle_name)s"
             msg = msg % dict(language=match.language, subtitle_name=subname)
             print(msg)
 
-        else:
-            msg = (
-                "Skipping %(language)s ,"
-                "filename %(subtitle_name)s already exists"
-            )
-            msg = msg % dict(language=match.language, subtitle_name=subname)
-            print(msg)
+            yield subname
+
+    stages = [
+        pipeline.Stage(name, func, workers=workers_[name], maxsize=queue_size)
+        for (name, func) in [
+            ("resolve", resolve),
+            ("fetch", fetch),
+            ("select", select),
+            ("download", download),
+        ]
+    ]
+
+    return pipeline.Pipeline(stages, on_error=on_error)
+
+
+def _report_error(stage, item, e):
+    filename = item[0] if isinstance(item, tuple) else item
+
+    if isinstance(e, tusubtitulo.ParseError):
+        msg = "Unable to parse '%(filename)s': %(error)s"
+        msg = msg % dict(filename=filename, error=str(e))
+
+    elif isinstance(e, tusubtitulo.ShowNotFoundError):
+        msg = "Show not found: %(show)s"
+        msg = msg % dict(show=e.show)
+
+    else:
+        msg = "Error on %(stage)s for '%(filename)s': %(error)s"
+        msg = msg % dict(stage=stage, filename=filename, error=str(e))
+
+    print(msg, file=sys.stderr)
+
+
+def download_all(
+    filenames,
+    languages=None,
+    workers=None,
+    queue_size=4,
+    session=None,
+    negative_cache=None,
+    negative_ttls=None,
+    aliases=None,
+    record=None,
+    replay_from=None,
+    replay_opts=None,
+    cache_uri=None,
+    index_path=None,
+    on_error=None,
+):
+    if replay_from:
+        fetcher = replay.ReplayFetcher(replay_from, **(replay_opts or {}))
+    else:
+        fetcher = tsapi.Fetcher()
+
+    if record:
+        fetcher = replay.RecordingFetcher(fetcher, record)
+
+    store = None
+    if session:
+        store = storage.SessionStore(session)
+        store.restore(fetcher)
+
+    negative = None
+    if negative_cache:
+        negative = cache.NegativeCache(negative_cache, ttls=negative_ttls)
+
+    backend = None
+    if cache_uri:
+        backend = cache.open_backend(cache_uri)
+
+    api = tusubtitulo.API(
+        fetcher=fetcher,
+        negative_cache=negative,
+        aliases=storage.AliasTable(aliases) if aliases else None,
+        cache=backend,
+    )
+
+    if index_path:
+        try:
+            api.show_index = _open_index(api, index_path)
+        except Exception as e:
+            # Shows are still found through the index page
+            msg = "Unable to use index '%(index)s': %(error)s"
+            msg = msg % dict(index=index_path, error=str(e))
+            print(msg, file=sys.stderr)
+
+    p = build_pipeline(
+        api,
+        languages=languages,
+        workers=workers,
+        queue_size=queue_size,
+        on_error=on_error,
+    )
+
+    try:
+        p.run(filenames)
+    finally:
+        if api.show_index:
+            api.show_index.close()
+        if store:
+            store.save(fetcher)
+        if record:
+            fetcher.save()
+
+    return p.stats
+
+
+def _open_index(api, index_path):
+    # Rebuild the compiled index once it is as old as the cached index would
+    # be
+    try:
+        age = time.time() - path.getmtime(index_path)
+    except OSError:
+        age = None
+
+    if age is None or age > api.cache_ttls["index"]:
+        api.compile_index(index_path)
+
+    return index.CompiledIndex(index_path)
+
+
+def download_for(filename, languages=None):
+    # Keep raising errors to the caller, like before the pipeline
+    errors = []
+    download_all(
+        [filename],
+        languages=languages,
+        on_error=lambda stage, item, e: errors.append(e),
+    )
+
+    if errors:
+        raise errors[0]
+
+
+def _workers_arg(value):
+    try:
+        stage, n = value.split("=", 1)
+        n = int(n)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected STAGE=N")
+
+    if stage not in DEFAULT_WORKERS:
+        raise argparse.ArgumentTypeError("Unknown stage: %s" % stage)
+
+    if n < 1:
+        raise argparse.ArgumentTypeError("Workers must be >= 1")
+
+    return (stage, n)
+
+
+def _queue_size_arg(value):
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a number")
+
+    # queue.Queue treats sizes <= 0 as unbounded, ie. no backpressure
+    if n < 1:
+        raise argparse.ArgumentTypeError("Queue size must be >= 1")
+
+    return n
+
+
+def _ttl_arg(value):
+    try:
+        kind, ttl = value.split("=", 1)
+        ttl = int(ttl)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected KIND=SECONDS")
+
+    if kind not in cache.NegativeCache.KINDS:
+        raise argparse.ArgumentTypeError("Unknown kind: %s" % kind)
+
+    return (kind, ttl)
+
+
+def _rate_arg(value):
+    try:
+        rate = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a number")
+
+    if not 0.0 <= rate <= 1.0:
+        raise argparse.ArgumentTypeError("Must be between 0 and 1")
+
+    return rate
 
 
 def main():
@@ -82,6 +319,104 @@ def main():
         default=[],
         type=str,
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        action="append",
+        default=[],
+        type=_workers_arg,
+        help="Worker count for a stage, as STAGE=N. Stages: "
+        + ", ".join(DEFAULT_WORKERS),
+    )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        default=4,
+        type=_queue_size_arg,
+        help="Maximum number of items waiting on each stage",
+    )
+    parser.add_argument(
+        "--stats",
+        dest="stats",
+        action="store_true",
+        help="Print per-stage throughput and queue depth",
+    )
+    parser.add_argument(
+        "--session",
+        dest="session",
+        default=None,
+        help="Load and save cookies and referer from/to this file",
+    )
+    parser.add_argument(
+        "--negative-cache",
+        dest="negative_cache",
+        default=None,
+        help="Remember failed lookups in this file",
+    )
+    parser.add_argument(
+        "--negative-ttl",
+        dest="negative_ttls",
+        action="append",
+        default=[],
+        type=_ttl_arg,
+        help="Seconds to remember a failed lookup, as KIND=SECONDS. Kinds: "
+        + ", ".join(cache.NegativeCache.KINDS),
+    )
+    parser.add_argument(
+        "--aliases",
+        dest="aliases",
+        default=None,
+        help="Show name to show id mapping file, updated on each match",
+    )
+    parser.add_argument(
+        "--cache",
+        dest="cache",
+        default=None,
+        help=(
+            "Cache index and season pages in 'memory', a directory or "
+            "memcached://host:port"
+        ),
+    )
+    parser.add_argument(
+        "--index",
+        dest="index",
+        default=None,
+        help="Compiled show index, built if missing or outdated",
+    )
+    parser.add_argument(
+        "--record",
+        dest="record",
+        default=None,
+        help="Record all HTTP responses into this archive",
+    )
+    parser.add_argument(
+        "--replay",
+        dest="replay",
+        default=None,
+        help="Serve HTTP responses from this archive instead of the network",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        dest="replay_latency",
+        default=0.0,
+        type=float,
+        help="Seconds to wait on each replayed request",
+    )
+    parser.add_argument(
+        "--replay-jitter",
+        dest="replay_jitter",
+        default=0.0,
+        type=float,
+        help="Random variation, in seconds, added to --replay-latency",
+    )
+    parser.add_argument(
+        "--replay-error-rate",
+        dest="replay_error_rate",
+        default=0.0,
+        type=_rate_arg,
+        help="Probability (0-1) of a replayed request failing",
+    )
     parser.add_argument(dest="filenames", nargs="+")
     args = parser.parse_args(sys.argv[1:])
 
@@ -89,16 +424,40 @@ def main():
         args.print_help()
         sys.exit(1)
 
-    for x in args.filenames:
-        try:
-            download_for(x, languages=[x.lower() for x in args.languages])
-
-        except tusubtitulo.ParseError as e:
-            msg = "Unable to parse '%(filename)s': %(error)s"
-            msg = msg % dict(filename=x, error=str(e))
-            print(msg, file=sys.stderr)
+    stats = download_all(
+        args.filenames,
+        languages=[x.lower() for x in args.languages],
+        workers=dict(args.workers),
+        queue_size=args.queue_size,
+        session=args.session,
+        negative_cache=args.negative_cache,
+        negative_ttls=dict(args.negative_ttls),
+        aliases=args.aliases,
+        record=args.record,
+        replay_from=args.replay,
+        replay_opts=dict(
+            latency=args.replay_latency,
+            jitter=args.replay_jitter,
+            error_rate=args.replay_error_rate,
+        ),
+        cache_uri=args.cache,
+        index_path=args.index,
+    )
 
-        except tusubtitulo.ShowNotFoundError as e:
-            msg = "Show not found: %(show)s"
-            msg = msg % dict(show=e.show)
+    if args.stats:
+        for st in stats:
+            msg = (
+                "%(name)s: %(workers)d workers, %(processed)d processed, "
+                "%(errors)d errors, %(throughput).2f items/s, "
+                "queue depth %(mean_depth).1f avg / %(max_depth)d max"
+            )
+            msg = msg % dict(
+                name=st.name,
+                workers=st.workers,
+                processed=st.processed,
+                errors=st.errors,
+                throughput=st.throughput,
+                mean_depth=st.mean_depth,
+                max_depth=st.max_depth,
+            )
             print(msg, file=sys.stderr)
@@ -0,0 +1,314 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import array
+import bisect
+import collections
+import difflib
+import mmap
+import re
+import struct
+import sys
+import zlib
+
+from tusubtitulo import storage
+
+
+# File layout, all integers are little-endian uint32:
+#
+#   header    magic, version, n (shows), t (trigrams), p (postings),
+#             norm blob size, title blob size
+#   norm_off  [n + 1] offsets of each normalized title in the norm blob
+#   title_off [n + 1] offsets of each title in the title blob
+#   ids       [n]     show ids
+#   tri_count [n]     number of distinct trigrams of each show
+#   tri_keys  [t]     sorted crc32 of each trigram
+#   tri_off   [t + 1] offsets of each trigram postings
+#   postings  [p]     show indexes
+#   norm blob         utf-8 normalized titles, sorted
+#   title blob        utf-8 original titles
+#
+# Shows are sorted by normalized title so exact lookups are a binary search.
+
+MAGIC = b"TSIX"
+VERSION = 1
+
+_HEADER = struct.Struct("<4s6I")
+
+
+def normalize(title):
+    return " ".join(title.lower().split())
+
+
+def trigrams(normalized):
+    padded = " " + normalized + " "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def _trigram_key(trigram):
+    return zlib.crc32(trigram.encode("utf-8"))
+
+
+def _u32(values):
+    arr = array.array("I", values)
+    if arr.itemsize != 4:
+        arr = array.array("L", values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+
+    return arr.tobytes()
+
+
+def compile_index(table):
+    """
+    Build the binary index from a parse_index_page result ({title: url}).
+    """
+    shows = []
+    for (title, url) in table.items():
+        m = re.search(r"/show/(\d+)", url)
+        if m:
+            shows.append((normalize(title), title, int(m.group(1))))
+
+    shows.sort(key=lambda x: (x[0].encode("utf-8"), x[1]))
+
+    norm_blob = bytearray()
+    title_blob = bytearray()
+    norm_off = [0]
+    title_off = [0]
+    ids = []
+    tri_count = []
+    postings = collections.defaultdict(list)
+
+    for (idx, (norm, title, id)) in enumerate(shows):
+        norm_blob += norm.encode("utf-8")
+        title_blob += title.encode("utf-8")
+        norm_off.append(len(norm_blob))
+        title_off.append(len(title_blob))
+        ids.append(id)
+
+        keys = {_trigram_key(x) for x in trigrams(norm)}
+        tri_count.append(len(keys))
+        for key in keys:
+            postings[key].append(idx)
+
+    tri_keys = sorted(postings)
+    tri_off = [0]
+    flat = []
+    for key in tri_keys:
+        flat.extend(postings[key])
+        tri_off.append(len(flat))
+
+    header = _HEADER.pack(
+        MAGIC,
+        VERSION,
+        len(shows),
+        len(tri_keys),
+        len(flat),
+        len(norm_blob),
+        len(title_blob),
+    )
+
+    return b"".join(
+        [
+            header,
+            _u32(norm_off),
+            _u32(title_off),
+            _u32(ids),
+            _u32(tri_count),
+            _u32(tri_keys),
+            _u32(tri_off),
+            _u32(flat),
+            bytes(norm_blob),
+            bytes(title_blob),
+        ]
+    )
+
+
+def write_index(filepath, table):
+    with storage.atomic_write(filepath, "wb") as fh:
+        fh.write(compile_index(table))
+
+
+class CompiledIndex:
+    """
+    Read-only view over a compiled index.
+
+    Only the sections touched by a query are read, nothing is built per
+    show on open.
+    """
+
+    def __init__(self, filepath=None, buff=None):
+        if buff is None:
+            with open(filepath, "rb") as fh:
+                buff = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._buff = buff
+
+        header = _HEADER.unpack_from(buff)
+        (magic, version, n, t, p, norm_size, title_size) = header
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a compiled index or unsupported version")
+
+        self._n = n
+
+        offset = _HEADER.size
+        sections = {}
+        for (name, count) in [
+            ("norm_off", n + 1),
+            ("title_off", n + 1),
+            ("ids", n),
+            ("tri_count", n),
+            ("tri_keys", t),
+            ("tri_off", t + 1),
+            ("postings", p),
+        ]:
+            sections[name] = self._array(offset, count)
+            offset += count * 4
+
+        self._norm_off = sections["norm_off"]
+        self._title_off = sections["title_off"]
+        self._ids = sections["ids"]
+        self._tri_count = sections["tri_count"]
+        self._tri_keys = sections["tri_keys"]
+        self._tri_off = sections["tri_off"]
+        self._postings = sections["postings"]
+
+        self._norm_base = offset
+        self._title_base = offset + norm_size
+
+        if self._title_base + title_size > len(buff):
+            raise ValueError("Truncated index")
+
+    def _array(self, offset, count):
+        view = memoryview(self._buff)[offset : offset + count * 4]
+        if sys.byteorder == "little":
+            return view.cast("I")
+
+        # Big-endian hosts need a swapped copy
+        arr = array.array("I")
+        arr.frombytes(view)
+        arr.byteswap()
+        return arr
+
+    def __len__(self):
+        return self._n
+
+    def _norm(self, idx):
+        a = self._norm_base + self._norm_off[idx]
+        b = self._norm_base + self._norm_off[idx + 1]
+        return self._buff[a:b]
+
+    def title(self, idx):
+        a = self._title_base + self._title_off[idx]
+        b = self._title_base + self._title_off[idx + 1]
+        return self._buff[a:b].decode("utf-8")
+
+    def id(self, idx):
+        return str(self._ids[idx])
+
+    def _bisect(self, norm):
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._norm(mid) < norm:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def lookup(self, title):
+        """
+        Indexes of shows whose normalized title equals title's.
+        """
+        norm = normalize(title).encode("utf-8")
+        ret = []
+        idx = self._bisect(norm)
+        while idx < self._n and self._norm(idx) == norm:
+            ret.append(idx)
+            idx += 1
+
+        return ret
+
+    def candidates(self, title, limit=5):
+        """
+        Indexes of the `limit` shows sharing more trigrams with title.
+        """
+        keys = {_trigram_key(x) for x in trigrams(normalize(title))}
+        counts = collections.Counter()
+        for key in keys:
+            pos = bisect.bisect_left(self._tri_keys, key)
+            if pos < len(self._tri_keys) and self._tri_keys[pos] == key:
+                start = self._tri_off[pos]
+                end = self._tri_off[pos + 1]
+                counts.update(self._postings[start:end].tolist())
+
+        scored = [
+            (2 * shared / (len(keys) + self._tri_count[idx]), idx)
+            for (idx, shared) in counts.items()
+        ]
+        scored.sort(reverse=True)
+
+        return [idx for (_, idx) in scored[:limit]]
+
+    def find(self, title, threshold=0.75):
+        """
+        Same matching rules as API.get_show: exact title, then lowercase,
+        then the most similar title if it is at least `threshold` similar.
+
+        Returns (title, id) or None.
+        """
+        matches = self.lookup(title)
+        if matches:
+            for idx in matches:
+                if self.title(idx) == title:
+                    return (self.title(idx), self.id(idx))
+
+            return (self.title(matches[0]), self.id(matches[0]))
+
+        norm = normalize(title)
+        best = None
+        for idx in self.candidates(title):
+            other = self._norm(idx).decode("utf-8")
+            ratio = difflib.SequenceMatcher(None, norm, other).ratio()
+            if best is None or ratio > best[0]:
+                best = (ratio, idx)
+
+        if best and best[0] >= threshold:
+            return (self.title(best[1]), self.id(best[1]))
+
+        return None
+
+    def close(self):
+        for name in (
+            "_norm_off",
+            "_title_off",
+            "_ids",
+            "_tri_count",
+            "_tri_keys",
+            "_tri_off",
+            "_postings",
+        ):
+            arr = getattr(self, name)
+            if isinstance(arr, memoryview):
+                arr.release()
+
+        if isinstance(self._buff, mmap.mmap):
+            self._buff.close()
@@ -0,0 +1,227 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import queue
+import threading
+import time
+
+
+_STOP = object()
+
+
+class Stage:
+    """
+    A pipeline step.
+
+    `func` is called with one item and must return an iterable (usually it
+    is a generator) with the items for the next stage, so a stage can drop,
+    pass or fan-out items.
+    """
+
+    def __init__(self, name, func, workers=1, maxsize=0):
+        if workers < 1:
+            raise ValueError("workers must be >= 1")
+
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.maxsize = maxsize
+
+
+class StageStats:
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.started = None
+        self.finished = None
+
+        self._depth_sum = 0
+        self._depth_samples = 0
+
+    def sample_depth(self, depth):
+        self.max_depth = max(self.max_depth, depth)
+        self._depth_sum += depth
+        self._depth_samples += 1
+
+    @property
+    def mean_depth(self):
+        if not self._depth_samples:
+            return 0.0
+
+        return self._depth_sum / self._depth_samples
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+
+        return self.processed / elapsed
+
+    def __repr__(self):
+        fmt = (
+            "<{mod}.{cls} {name} workers:{workers} processed:{processed} "
+            "errors:{errors} throughput:{throughput:.2f}/s "
+            "depth:{mean_depth:.1f}/{max_depth}>"
+        )
+        return fmt.format(
+            mod=__name__,
+            cls=self.__class__.__name__,
+            name=self.name,
+            workers=self.workers,
+            processed=self.processed,
+            errors=self.errors,
+            throughput=self.throughput,
+            mean_depth=self.mean_depth,
+            max_depth=self.max_depth,
+        )
+
+
+class Pipeline:
+    """
+    Runs items through a chain of stages.
+
+    Each stage has its own pool of worker threads and reads from a bounded
+    queue, so a slow stage blocks the upstream ones (backpressure) without
+    stalling unrelated work already queued downstream.
+
+    Errors raised by a stage function are passed to `on_error(stage_name,
+    item, exception)`; the item is dropped and processing continues.
+    """
+
+    def __init__(self, stages, on_error=None):
+        if not stages:
+            raise ValueError("At least one stage is required")
+
+        self.stages = list(stages)
+        self.on_error = on_error
+        self.stats = [StageStats(s.name, s.workers) for s in self.stages]
+
+        self._queues = [queue.Queue(maxsize=s.maxsize) for s in self.stages]
+        self._alive = [s.workers for s in self.stages]
+        self._lock = threading.Lock()
+        self._results = []
+
+    def run(self, items):
+        threads = []
+        for (idx, stage) in enumerate(self.stages):
+            for n in range(stage.workers):
+                t = threading.Thread(
+                    target=self._worker,
+                    args=(idx,),
+                    name="{}-{}".format(stage.name, n),
+                    daemon=True,
+                )
+                t.start()
+                threads.append(t)
+
+        for item in items:
+            self._put(0, item)
+        self._stop(0)
+
+        for t in threads:
+            t.join()
+
+        return self._results
+
+    def _put(self, idx, item):
+        q = self._queues[idx]
+        q.put(item)
+        with self._lock:
+            self.stats[idx].sample_depth(q.qsize())
+
+    def _stop(self, idx):
+        for _ in range(self.stages[idx].workers):
+            self._queues[idx].put(_STOP)
+
+    def _emit(self, idx, item):
+        if idx + 1 < len(self.stages):
+            self._put(idx + 1, item)
+        else:
+            with self._lock:
+                self._results.append(item)
+
+    def _worker(self, idx):
+        try:
+            self._consume(idx)
+
+        finally:
+            with self._lock:
+                self._alive[idx] -= 1
+                last = self._alive[idx] == 0
+                if last:
+                    self.stats[idx].finished = time.monotonic()
+
+            if last and idx + 1 < len(self.stages):
+                self._stop(idx + 1)
+
+    def _consume(self, idx):
+        stage = self.stages[idx]
+        stats = self.stats[idx]
+        q = self._queues[idx]
+
+        while True:
+            item = q.get()
+            if item is _STOP:
+                break
+
+            now = time.monotonic()
+            with self._lock:
+                if stats.started is None:
+                    stats.started = now
+
+            try:
+                for output in stage.func(item):
+                    self._emit(idx, output)
+
+            except Exception as e:
+                with self._lock:
+                    stats.errors += 1
+                self._report(stage.name, item, e)
+
+            else:
+                with self._lock:
+                    stats.processed += 1
+
+            finally:
+                with self._lock:
+                    stats.busy += time.monotonic() - now
+
+    def _report(self, stage_name, item, e):
+        if not self.on_error:
+            return
+
+        try:
+            self.on_error(stage_name, item, e)
+        except Exception:
+            # A broken error handler must not kill the worker, the
+            # pipeline would never finish
+            pass
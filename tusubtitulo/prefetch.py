@@ -0,0 +1,201 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import threading
+import time
+
+
+class _Tracked:
+    def __init__(self, showinfo, season, now):
+        self.showinfo = showinfo
+        self.season = season
+        self.requested = now
+        self.last_flip = now
+        self.due = now
+        self.completed = None
+        self.failures = 0
+        # episode -> names used to request it, see API.forget_incomplete
+        self.waiting = {}
+
+
+class PrefetchScheduler:
+    """
+    Refreshes season pages in the background for seasons with translations
+    in progress, so the next lookup finds them in the API cache.
+
+    The refresh interval adapts to the season activity: it is the time since
+    a row last flipped to "completado", bounded by `min_interval` and
+    `max_interval`. Seasons not requested for `expire` seconds, or without
+    pending translations, are no longer tracked.
+
+    It is meant for long running processes using the API with a cache
+    backend (set it as `API.prefetcher` and call `start()`). Short runs
+    like the CLI end well before the first refresh.
+    """
+
+    def __init__(
+        self,
+        api,
+        min_interval=60,
+        max_interval=60 * 60,
+        expire=6 * 60 * 60,
+        clock=time.monotonic,
+    ):
+        self.api = api
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.expire = expire
+
+        self._clock = clock
+        self._tracked = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def track(self, showinfo, season, episode=None, name=None):
+        now = self._clock()
+        key = (showinfo.id, season)
+
+        with self._cond:
+            entry = self._tracked.get(key)
+            if entry is None:
+                entry = _Tracked(showinfo, season, now)
+                entry.due = now + self.min_interval
+                self._tracked[key] = entry
+            else:
+                entry.requested = now
+
+            if episode is not None and name is not None:
+                entry.waiting.setdefault(episode, set()).add(name)
+
+            self._cond.notify()
+
+    @property
+    def tracked(self):
+        with self._cond:
+            return [(e.showinfo, e.season) for e in self._tracked.values()]
+
+    def _interval(self, entry, now):
+        interval = max(now - entry.last_flip, self.min_interval)
+        # Back off on errors
+        interval *= 2 ** min(entry.failures, 6)
+
+        return min(interval, self.max_interval)
+
+    def run_pending(self):
+        now = self._clock()
+
+        with self._cond:
+            for (key, entry) in list(self._tracked.items()):
+                if now - entry.requested > self.expire:
+                    del self._tracked[key]
+
+            due = [e for e in self._tracked.values() if e.due <= now]
+
+        for entry in due:
+            self._refresh(entry)
+
+    def _refresh(self, entry):
+        try:
+            rows = self.api.get_season(
+                entry.showinfo, entry.season, refresh=True
+            )
+
+        except Exception:
+            now = self._clock()
+            with self._cond:
+                entry.failures += 1
+                entry.due = now + self._interval(entry, now)
+            return
+
+        now = self._clock()
+        completed = set()
+        pending = False
+        for (ep, title, version, language, done, url) in rows:
+            if done:
+                completed.add((ep, version, language))
+            else:
+                pending = True
+
+        forget = []
+        with self._cond:
+            entry.failures = 0
+
+            # On the first refresh there is no previous state, rows already
+            # completed then are counted as flipped
+            flipped = completed - (entry.completed or set())
+            if flipped:
+                entry.last_flip = now
+                for (ep, version, language) in flipped:
+                    for name in entry.waiting.pop(ep, ()):
+                        forget.append((name, ep))
+
+            entry.completed = completed
+            entry.due = now + self._interval(entry, now)
+
+            if not pending:
+                self._tracked.pop((entry.showinfo.id, entry.season), None)
+
+        # The negative cache may do file I/O, keep it out of the lock and
+        # don't let its errors stop the scheduler
+        for (name, ep) in forget:
+            try:
+                self.api.forget_incomplete(name, entry.season, ep)
+            except Exception:
+                pass
+
+    def _next_due(self):
+        if not self._tracked:
+            return None
+
+        return min(e.due for e in self._tracked.values())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+
+                due = self._next_due()
+                timeout = None if due is None else due - self._clock()
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+
+            self.run_pending()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="prefetch", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
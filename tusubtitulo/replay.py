@@ -0,0 +1,190 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import zipfile
+
+from tusubtitulo import storage
+from tusubtitulo.api import FetchError, Response
+
+
+# Archive layout (a zip file):
+#   index.json: {url: {"status": int, "encoding": str, "body": name}}
+#   bodies/<sha1 of content>: response content, shared between equal bodies
+_INDEX = "index.json"
+
+
+def _load_archive(filepath):
+    entries = {}
+
+    with zipfile.ZipFile(filepath, "r") as zf:
+        index = json.loads(zf.read(_INDEX).decode("utf-8"))
+        for (url, meta) in index.items():
+            body = zf.read(meta["body"]) if meta.get("body") else b""
+            entries[url] = (meta["status"], meta.get("encoding"), body)
+
+    return entries
+
+
+def _save_archive(filepath, entries):
+    index = {}
+    bodies = {}
+    for (url, (status, encoding, content)) in entries.items():
+        name = None
+        if content:
+            name = "bodies/" + hashlib.sha1(content).hexdigest()
+            bodies[name] = content
+
+        index[url] = {"status": status, "encoding": encoding, "body": name}
+
+    with storage.atomic_write(filepath, "wb") as fh:
+        with zipfile.ZipFile(fh, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(_INDEX, json.dumps(index, indent=1, sort_keys=True))
+            for (name, content) in bodies.items():
+                zf.writestr(name, content)
+
+
+class RecordingFetcher:
+    """
+    Wraps a fetcher and records every response into an archive.
+
+    Existing archives are extended, call `save()` (or use it as a context
+    manager) to write it.
+    """
+
+    def __init__(self, fetcher, filepath):
+        self._fetcher = fetcher
+        self._path = filepath
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        if os.path.exists(filepath):
+            self._entries.update(_load_archive(filepath))
+
+    def fetch(self, url, headers={}):
+        try:
+            resp = self._fetcher.fetch(url, headers)
+
+        except FetchError as e:
+            with self._lock:
+                self._entries[url] = (e.status, None, b"")
+            raise
+
+        content = resp.content
+        if isinstance(content, str):
+            content = content.encode(resp.encoding or "utf-8")
+
+        with self._lock:
+            self._entries[url] = (200, resp.encoding, content)
+
+        return resp
+
+    def get_state(self):
+        return self._fetcher.get_state()
+
+    def set_state(self, state):
+        self._fetcher.set_state(state)
+
+    def save(self):
+        with self._lock:
+            _save_archive(self._path, self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+
+class ReplayFetcher:
+    """
+    Serves responses from an archive written by RecordingFetcher.
+
+    Each fetch waits `latency` ± `jitter` seconds and fails with a
+    FetchError (status 503) with probability `error_rate`. URLs missing
+    from the archive fail with status 404.
+    """
+
+    def __init__(
+        self,
+        filepath,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        seed=None,
+        sleep=time.sleep,
+    ):
+        if not 0.0 <= error_rate <= 1.0:
+            raise ValueError("error_rate must be between 0 and 1")
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+        self._entries = _load_archive(filepath)
+        self._sleep = sleep
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._state = {"headers": {"Referer": ""}, "cookies": {}}
+
+    def fetch(self, url, headers={}):
+        with self._lock:
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(-self.jitter, self.jitter)
+            failed = self._random.random() < self.error_rate
+
+        if delay > 0:
+            self._sleep(delay)
+
+        if failed:
+            raise FetchError(url, 503)
+
+        try:
+            (status, encoding, content) = self._entries[url]
+        except KeyError:
+            raise FetchError(url, 404)
+
+        if status != 200:
+            raise FetchError(url, status)
+
+        with self._lock:
+            self._state["headers"]["Referer"] = url
+
+        return Response(url, content, encoding, status)
+
+    def get_state(self):
+        with self._lock:
+            return {
+                "headers": dict(self._state["headers"]),
+                "cookies": dict(self._state["cookies"]),
+            }
+
+    def set_state(self, state):
+        with self._lock:
+            self._state = {
+                "headers": dict(state.get("headers", {})),
+                "cookies": dict(state.get("cookies", {})),
+            }
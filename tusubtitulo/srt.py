@@ -0,0 +1,224 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import array
+import codecs
+import itertools
+import re
+
+
+# Optional cue number line, timing line and text up to the next blank line
+_CUE_RE = re.compile(
+    r"(?:^[ \t]*\d+[ \t]*\n)?"
+    r"^[ \t]*(\d+):(\d\d):(\d\d)[,.](\d{1,3})[ \t]*-->[ \t]*"
+    r"(\d+):(\d\d):(\d\d)[,.](\d{1,3})[^\n]*\n"
+    r"(.*?)(?=\n[ \t]*\n|(?<=\n)[ \t]*\n|\Z)",
+    re.MULTILINE | re.DOTALL,
+)
+
+_BOMS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+]
+
+# Tried in order when there is no BOM. Most subtitles from the site are
+# utf-8 or windows-1252, latin-1 never fails.
+FALLBACK_ENCODINGS = ("utf-8", "cp1252", "latin-1")
+
+
+def decode(buff, encoding=None):
+    """
+    Decode subtitle bytes to text with "\\n" newlines.
+
+    Returns (text, encoding).
+    """
+    if encoding is None:
+        for (bom, enc) in _BOMS:
+            if buff.startswith(bom):
+                buff = buff[len(bom) :]
+                encoding = enc
+                break
+
+    if encoding is None:
+        for enc in FALLBACK_ENCODINGS:
+            try:
+                text = buff.decode(enc)
+            except UnicodeDecodeError:
+                continue
+
+            encoding = enc
+            break
+    else:
+        text = buff.decode(encoding)
+
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return (text, encoding)
+
+
+def _times(hours, minutes, seconds, fracs):
+    if any(len(x) < 3 for x in fracs):
+        fracs = [x.ljust(3, "0") for x in fracs]
+
+    return array.array(
+        "q",
+        [
+            h * 3600000 + m * 60000 + s * 1000 + f
+            for (h, m, s, f) in zip(
+                map(int, hours),
+                map(int, minutes),
+                map(int, seconds),
+                map(int, fracs),
+            )
+        ],
+    )
+
+
+def _affine(times, factor, offset):
+    # Still one Python operation per time, the gain of the columnar layout
+    # is memory and not building cue objects, not vectorized arithmetic
+    if factor == 1:
+        offset = int(round(offset))
+        if not times or min(times) + offset >= 0:
+            return array.array("q", [t + offset for t in times])
+
+        return array.array("q", [max(t + offset, 0) for t in times])
+
+    return array.array(
+        "q", [max(int(round(t * factor + offset)), 0) for t in times]
+    )
+
+
+def _timestamp(ms):
+    return "%02d:%02d:%02d,%03d" % (
+        ms // 3600000,
+        ms // 60000 % 60,
+        ms // 1000 % 60,
+        ms % 1000,
+    )
+
+
+class Cues:
+    """
+    Compact subtitle track.
+
+    Start and end times are millisecond arrays and all the cue texts share
+    one string, cue `i` text being text[offsets[i]:offsets[i + 1]], so a
+    track takes a fraction of the memory of per-cue objects. Retiming only
+    touches the time arrays and returns a new object sharing the text.
+    """
+
+    def __init__(self, starts, ends, text, offsets):
+        if not (len(starts) == len(ends) == len(offsets) - 1):
+            raise ValueError("Inconsistent cue arrays")
+
+        self.starts = starts
+        self.ends = ends
+        self.text = text
+        self.offsets = offsets
+
+    @classmethod
+    def parse(cls, buff, encoding=None):
+        if isinstance(buff, bytes):
+            (buff, encoding) = decode(buff, encoding)
+        else:
+            buff = buff.replace("\r\n", "\n").replace("\r", "\n")
+
+        matches = _CUE_RE.findall(buff)
+
+        # Column by column, avoids building per cue objects
+        columns = list(zip(*matches)) or [()] * 9
+        starts = _times(*columns[0:4])
+        ends = _times(*columns[4:8])
+
+        texts = [x.strip("\n") for x in columns[8]]
+        offsets = array.array("q", [0])
+        offsets.extend(itertools.accumulate(map(len, texts)))
+
+        return cls(starts, ends, "".join(texts), offsets)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def cue_text(self, idx):
+        return self.text[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def __iter__(self):
+        text = self.text
+        offsets = self.offsets
+        for idx in range(len(self.starts)):
+            yield (
+                self.starts[idx],
+                self.ends[idx],
+                text[offsets[idx] : offsets[idx + 1]],
+            )
+
+    def retime(self, factor=1.0, offset=0):
+        """
+        Apply t * factor + offset (ms) to every time, clamped at zero.
+        """
+        return Cues(
+            _affine(self.starts, factor, offset),
+            _affine(self.ends, factor, offset),
+            self.text,
+            self.offsets,
+        )
+
+    def shift(self, ms):
+        """
+        Move every cue by `ms` milliseconds.
+        """
+        return self.retime(offset=ms)
+
+    def scale(self, factor, origin=0):
+        """
+        Stretch times by `factor` around `origin` (ms), ie. for framerate
+        conversions: scale(25 / 23.976).
+        """
+        return self.retime(factor=factor, offset=origin * (1 - factor))
+
+    def to_srt(self, encoding="utf-8", newline="\r\n"):
+        text = self.text
+        offsets = self.offsets
+        parts = [
+            "%d\n%s --> %s\n%s\n\n"
+            % (idx, _timestamp(start), _timestamp(end), text[a:b])
+            for (idx, start, end, a, b) in zip(
+                itertools.count(1),
+                self.starts,
+                self.ends,
+                offsets,
+                itertools.islice(offsets, 1, None),
+            )
+        ]
+
+        buff = "".join(parts)
+        if newline != "\n":
+            buff = buff.replace("\n", newline)
+
+        return buff.encode(encoding)
+
+
+def normalize(buff, encoding="utf-8", newline="\r\n"):
+    """
+    Re-encode subtitle bytes, as returned by API.fetch_subtitle, to
+    `encoding` with consistent numbering and newlines.
+    """
+    return Cues.parse(buff).to_srt(encoding=encoding, newline=newline)
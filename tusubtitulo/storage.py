@@ -0,0 +1,220 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright (C) 2019 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import contextlib
+import json
+import os
+import tempfile
+from os import path
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on this platform (ie. windows)
+    fcntl = None
+
+
+@contextlib.contextmanager
+def locked(filepath, exclusive=False):
+    """
+    Hold an advisory lock on `filepath`.lock for the duration of the block.
+
+    A sidecar file is used instead of `filepath` itself because writers
+    replace `filepath` atomically and a lock on the old inode would be lost.
+    """
+    dirname = path.dirname(path.abspath(filepath))
+    os.makedirs(dirname, exist_ok=True)
+
+    with open(filepath + ".lock", "a+") as fh:
+        if fcntl:
+            fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+        try:
+            yield
+
+        finally:
+            if fcntl:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def atomic_write(filepath, mode="w", **kwargs):
+    """
+    Open a temporary file next to `filepath` and move it over `filepath`
+    once the block completes, so readers never see a partial file.
+
+    On errors the temporary file is removed and `filepath` is untouched.
+    """
+    dirname = path.dirname(path.abspath(filepath))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tusubtitulo-")
+    try:
+        with os.fdopen(fd, mode, **kwargs) as fh:
+            yield fh
+        os.replace(tmp, filepath)
+
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class JSONFile:
+    """
+    A JSON document on disk that can be shared between processes.
+    """
+
+    def __init__(self, filepath):
+        self.path = filepath
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data):
+        with atomic_write(self.path, "w", encoding="utf-8") as fh:
+            json.dump(data, fh, indent=2, sort_keys=True)
+
+    def load(self):
+        with locked(self.path):
+            return self._read()
+
+    def update(self, fn):
+        """
+        Read-modify-write the document under an exclusive lock.
+
+        `fn` receives the current data and returns the data to be saved.
+        """
+        with locked(self.path, exclusive=True):
+            data = fn(self._read())
+            self._write(data)
+
+        return data
+
+
+class SessionStore:
+    """
+    Persists the fetcher's cookies and referer between runs.
+    """
+
+    def __init__(self, filepath):
+        self._file = JSONFile(filepath)
+
+    def restore(self, fetcher):
+        stored = self._file.load()
+        if not stored:
+            return False
+
+        state = fetcher.get_state()
+        state["headers"]["Referer"] = stored.get("referer", "")
+        state["cookies"].update(stored.get("cookies", {}))
+        fetcher.set_state(state)
+
+        return True
+
+    def save(self, fetcher):
+        state = fetcher.get_state()
+
+        def _merge(stored):
+            # Other processes may have saved cookies in the meantime, keep
+            # them unless we have a newer value
+            cookies = stored.get("cookies", {})
+            cookies.update(state["cookies"])
+
+            return {
+                "referer": state["headers"].get("Referer", ""),
+                "cookies": cookies,
+            }
+
+        self._file.update(_merge)
+
+
+class AliasTable:
+    """
+    Maps show names (as guessed from filenames) to show ids.
+
+    The file is plain JSON, users can edit it to add or fix entries:
+
+        {"marvels agents of shield": {"id": "1768", "title": "..."}}
+
+    Entries added automatically never replace existing ones, so manual
+    overrides are kept.
+    """
+
+    def __init__(self, filepath=None):
+        self._file = JSONFile(filepath) if filepath else None
+        self._memory = {}
+
+    @staticmethod
+    def _key(name):
+        return " ".join(name.lower().split())
+
+    def _load(self):
+        if self._file:
+            return self._file.load()
+
+        return self._memory
+
+    @staticmethod
+    def _valid_id(id):
+        if isinstance(id, bool):
+            return False
+
+        if isinstance(id, int):
+            return id > 0
+
+        return isinstance(id, str) and id.strip().isdigit()
+
+    def get(self, name):
+        entry = self._load().get(self._key(name))
+
+        # Hand-written entries can be just the id: "1768" or 1768
+        if not isinstance(entry, dict):
+            entry = {"id": entry}
+
+        # Anything else malformed is ignored, the show is searched again
+        id = entry.get("id")
+        if not self._valid_id(id):
+            return None
+
+        title = entry.get("title")
+        if not isinstance(title, str) or not title:
+            title = name
+
+        return {"id": str(id).strip(), "title": title}
+
+    def add(self, name, id, title, override=False):
+        key = self._key(name)
+
+        def _add(data):
+            if override or key not in data:
+                data[key] = {"id": str(id), "title": title}
+            return data
+
+        if self._file:
+            self._file.update(_add)
+        else:
+            _add(self._memory)